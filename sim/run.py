@@ -1,10 +1,18 @@
 import os
 import sys
-import traci
+# libsumo runs SUMO in-process, avoiding the TraCI socket round-trip on every
+# call. It does not support multiple clients or sumo-gui, neither of which is
+# used here.
+if os.environ.get('USE_LIBSUMO', '0') == '1':
+    import libsumo as traci
+else:
+    import traci
+import traci.constants as tc
 import csv
 from datetime import datetime
+from multiprocessing import Pool
 import numpy as np
-from collections import defaultdict
+from numba import njit
 
 # Add SUMO_HOME to path if not already there
 if 'SUMO_HOME' in os.environ:
@@ -13,32 +21,73 @@ if 'SUMO_HOME' in os.environ:
 else:
     sys.exit("Please declare SUMO_HOME environment variable")
 
-class AutonomousVehicle:
-    def __init__(self, vehicle_id):
-        self.vehicle_id = vehicle_id
-        traci.vehicle.setType(self.vehicle_id, "autonomous_passenger")
-
-    def perform_behavior(self):
-        # Implement specific behaviors for autonomous vehicles
-        pass
+@njit(cache=True)
+def _reduce_step(speeds, fuel, stop_state, waiting, congestion_threshold):
+    """Reduce one step of per-vehicle data to the time-series metrics in a single pass"""
+    n = speeds.shape[0]
+    stops = 0
+    fuel_sum = 0.0
+    speed_sum = 0.0
+    waiting_sum = 0.0
+    congested = 0
+    for i in range(n):
+        stops += stop_state[i] != 0
+        fuel_sum += fuel[i]
+        speed_sum += speeds[i]
+        waiting_sum += waiting[i]
+        congested += speeds[i] < congestion_threshold
+    return stops, fuel_sum, speed_sum / n, waiting_sum / n, congested
 
 class MixedTrafficSimulation:
-    def __init__(self, config_file, av_penetration_rate):
+    # Per-vehicle variables fetched in one batch every step
+    VEHICLE_VARS = [
+        tc.VAR_SPEED,
+        tc.VAR_FUELCONSUMPTION,
+        tc.VAR_STOPSTATE,
+        tc.VAR_ACCELERATION,
+        tc.VAR_ACCUMULATED_WAITING_TIME,
+    ]
+
+    # Per-step metrics, stored in preallocated float32 arrays indexed by step
+    TIME_SERIES_METRICS = (
+        "number_of_stops",
+        "fuel_consumption",
+        "mean_speed",
+        "average_travel_time",
+        "traffic_flow_rate",
+        "congestion_levels",
+    )
+
+    def __init__(self, config_file, av_penetration_rate, seed=None):
         self.config_file = config_file
         self.av_penetration_rate = av_penetration_rate
-        self.metrics = defaultdict(list)
+        self._rng = np.random.default_rng(seed)
+        self.metrics = {}
         self.adaptation_count = 0  # Track infrastructure adaptations
         self.emergency_brake_threshold = -7.5  # Threshold acceleration for emergency braking
-        self.autonomous_vehicles = set()
+        self.congestion_threshold = 5  # Speed threshold for congestion
+        self.metric_interval = 1  # Steps between time-series samples, set by run()
+        # Dense integer index per departed vehicle and AV flag per index
+        self._vehicle_index = {}
+        self._is_av = np.zeros(1024, dtype=np.bool_)
         # Initialize emergency braking counters
         self.metrics["emergency_braking_total"] = 0
         self.metrics["emergency_braking_av"] = 0
         self.metrics["emergency_braking_human"] = 0
+        self._tls_lanes = {}  # Controlled lanes per traffic light, static for the run
 
     def start_simulation(self):
-        # Start SUMO with TraCI
-        sumo_cmd = ["sumo", "-c", self.config_file]
-        traci.start(sumo_cmd)
+        # Start SUMO with TraCI (or in-process with libsumo)
+        # Prefix output files per rate so parallel runs don't overwrite each other
+        output_prefix = f"av{round(self.av_penetration_rate * 100)}_"
+        traci.start(["sumo", "-c", self.config_file, "--output-prefix", output_prefix])
+        # Simulation clock is derived locally from these instead of queried every step
+        self._begin_time = traci.simulation.getTime()
+        self._dt = traci.simulation.getDeltaT()
+        self._tls_lanes = {
+            tls_id: tuple(traci.trafficlight.getControlledLanes(tls_id))
+            for tls_id in traci.trafficlight.getIDList()
+        }
 
     def setup_vehicle_types(self):
         # Ensure autonomous vehicle type is defined
@@ -47,19 +96,15 @@ class MixedTrafficSimulation:
 
     def adapt_traffic_lights(self):
         """Dynamic traffic light adaptation based on current traffic conditions"""
-        for tls_id in traci.trafficlight.getIDList():
-            waiting_time = self._get_total_waiting_time(tls_id)
+        for tls_id, lanes in self._tls_lanes.items():
+            waiting_time = self._get_total_waiting_time(lanes)
             if waiting_time > 120:  # Threshold for adaptation
                 self._optimize_traffic_light(tls_id)
 
-    def _get_total_waiting_time(self, tls_id):
-        """Calculate total waiting time for vehicles at a traffic light"""
-        total_waiting_time = 0
-        for lane_id in traci.trafficlight.getControlledLanes(tls_id):
-            vehicles = traci.lane.getLastStepVehicleIDs(lane_id)
-            for veh_id in vehicles:
-                total_waiting_time += traci.vehicle.getWaitingTime(veh_id)
-        return total_waiting_time
+    def _get_total_waiting_time(self, lanes):
+        """Calculate total waiting time for vehicles on a traffic light's controlled lanes"""
+        # lane.getWaitingTime already sums over the vehicles on the lane
+        return sum(traci.lane.getWaitingTime(lane_id) for lane_id in lanes)
 
     def _optimize_traffic_light(self, tls_id):
         """Simple traffic light optimization logic"""
@@ -67,94 +112,104 @@ class MixedTrafficSimulation:
         traci.trafficlight.setPhaseDuration(tls_id, 10)  # Extend green time
         self.adaptation_count += 1  # Increment adaptation count
 
-    def detect_emergency_braking(self):
-        """Detect emergency braking events and log them."""
-        vehicles = traci.vehicle.getIDList()
-        for veh_id in vehicles:
-            accel = traci.vehicle.getAcceleration(veh_id)
-            if accel <= self.emergency_brake_threshold:
-                if veh_id in self.autonomous_vehicles:
-                    veh_type = 'Autonomous Vehicle'
-                    self.metrics["emergency_braking_av"] += 1
-                else:
-                    veh_type = 'Human-Driven Vehicle'
-                    self.metrics["emergency_braking_human"] += 1
-                self.metrics["emergency_braking_total"] += 1
-                print(f"Emergency braking detected: Vehicle ID {veh_id} ({veh_type}) at time {traci.simulation.getTime()}")
-
-    def collect_metrics(self):
-        """Collect basic metrics like number of stops and fuel consumption"""
-        vehicles = traci.vehicle.getIDList()
-        if not vehicles:
-            self.metrics["number_of_stops"].append(0)
-            self.metrics["fuel_consumption"].append(0)
-            self.metrics["mean_speed"].append(0)
-            return
-
-        stops = sum(1 for v in vehicles if traci.vehicle.getStopState(v))
-        fuel_consumption = sum(traci.vehicle.getFuelConsumption(v) for v in vehicles)
-        speeds = [traci.vehicle.getSpeed(v) for v in vehicles]
-
-        self.metrics["number_of_stops"].append(stops)
-        self.metrics["fuel_consumption"].append(fuel_consumption)
-        self.metrics["mean_speed"].append(sum(speeds) / len(vehicles))  # Fixed mean speed calculation
-
-    def collect_additional_metrics(self):
-        """Collect additional metrics like average travel time, traffic flow rate, and congestion levels"""
-        vehicles = traci.vehicle.getIDList()
-        if not vehicles:
-            self.metrics["average_travel_time"].append(0)
-            self.metrics["traffic_flow_rate"].append(0)
-            self.metrics["congestion_levels"].append(0)
+    def _register_vehicle(self, vehicle_id, is_av):
+        """Assign a departed vehicle the next dense index and record whether it is an AV"""
+        idx = len(self._vehicle_index)
+        if idx == len(self._is_av):
+            self._is_av = np.concatenate([self._is_av, np.zeros_like(self._is_av)])
+        self._vehicle_index[vehicle_id] = idx
+        self._is_av[idx] = is_av
+
+    @staticmethod
+    def _column(vehicles, var):
+        """Extract one subscribed variable for all vehicles as a float32 array"""
+        return np.fromiter((r[var] for r in vehicles.values()), dtype=np.float32, count=len(vehicles))
+
+    def collect_step(self, step, sim_time, vehicles):
+        """Collect time-series metrics every metric_interval steps and detect emergency braking every step"""
+        n = len(vehicles)
+        if not n:
+            return  # Time series are zero-initialised, nothing to record
+
+        # Emergency braking events (checked every step so none are missed)
+        braking = self._column(vehicles, tc.VAR_ACCELERATION) <= self.emergency_brake_threshold
+        if braking.any():
+            indices = np.fromiter((self._vehicle_index[v] for v in vehicles),
+                                  dtype=np.intp, count=n)
+            is_av = self._is_av[indices]
+            brake_total = np.count_nonzero(braking)
+            brake_av = np.count_nonzero(braking & is_av)
+            self.metrics["emergency_braking_total"] += brake_total
+            self.metrics["emergency_braking_av"] += brake_av
+            self.metrics["emergency_braking_human"] += brake_total - brake_av
+            veh_ids = np.fromiter(vehicles.keys(), dtype=object, count=n)
+            for i in np.flatnonzero(braking):
+                veh_type = 'Autonomous Vehicle' if is_av[i] else 'Human-Driven Vehicle'
+                print(f"Emergency braking detected: Vehicle ID {veh_ids[i]} ({veh_type}) at time {sim_time}")
+
+        if step % self.metric_interval:
             return
 
-        # Average travel time
-        travel_times = [traci.vehicle.getAccumulatedWaitingTime(v) for v in vehicles]
-        average_travel_time = sum(travel_times) / len(travel_times)
-        self.metrics["average_travel_time"].append(average_travel_time)
+        speeds = self._column(vehicles, tc.VAR_SPEED)
+        fuel = self._column(vehicles, tc.VAR_FUELCONSUMPTION)
+        stop_state = self._column(vehicles, tc.VAR_STOPSTATE)
+        waiting = self._column(vehicles, tc.VAR_ACCUMULATED_WAITING_TIME)
 
-        # Traffic flow rate
-        traffic_flow_rate = len(vehicles) / max(1, traci.simulation.getTime())  # Prevent division by zero
-        self.metrics["traffic_flow_rate"].append(traffic_flow_rate)
+        stops, fuel_sum, mean_speed, mean_waiting, congested = _reduce_step(
+            speeds, fuel, stop_state, waiting, self.congestion_threshold)
 
-        # Congestion levels (e.g., number of vehicles with speed < threshold)
-        congestion_threshold = 5  # Speed threshold for congestion
-        congested_vehicles = sum(1 for v in vehicles if traci.vehicle.getSpeed(v) < congestion_threshold)
-        self.metrics["congestion_levels"].append(congested_vehicles)
+        sample = step // self.metric_interval
+        self.metrics["number_of_stops"][sample] = stops
+        self.metrics["fuel_consumption"][sample] = fuel_sum
+        self.metrics["mean_speed"][sample] = mean_speed
+        self.metrics["average_travel_time"][sample] = mean_waiting
+        self.metrics["traffic_flow_rate"][sample] = n / max(1, sim_time)  # Prevent division by zero
+        self.metrics["congestion_levels"][sample] = congested
 
-    def run(self, steps=3600):
-        """Main simulation loop"""
+    def run(self, steps=3600, metric_interval=5):
+        """Main simulation loop, sampling time-series metrics every metric_interval steps"""
         self.start_simulation()
         self.setup_vehicle_types()
+        self.metric_interval = metric_interval
+        num_samples = -(-steps // metric_interval)  # ceil division
+        for name in self.TIME_SERIES_METRICS:
+            self.metrics[name] = np.zeros(num_samples, dtype=np.float32)
 
         step = 0
         while step < steps:
             traci.simulationStep()
 
             # Convert some new vehicles to autonomous vehicles
-            for vehicle_id in traci.simulation.getDepartedIDList():
-                if np.random.random() < self.av_penetration_rate:
-                    av = AutonomousVehicle(vehicle_id)
-                    self.autonomous_vehicles.add(vehicle_id)
-                    av.perform_behavior()
+            departed = traci.simulation.getDepartedIDList()
+            av_mask = self._rng.random(len(departed)) < self.av_penetration_rate
+            for vehicle_id, is_av in zip(departed, av_mask):
+                if is_av:
+                    traci.vehicle.setType(vehicle_id, "autonomous_passenger")
+                self._register_vehicle(vehicle_id, is_av)
+                # Subscribe after any type change so the first results reflect it
+                traci.vehicle.subscribe(vehicle_id, self.VEHICLE_VARS)
 
             # Adapt infrastructure periodically
             if step % 30 == 0:  # Check every 30 simulation steps
                 self.adapt_traffic_lights()
 
-            # Collect metrics at each step
-            self.collect_metrics()
-            self.collect_additional_metrics()
-            self.detect_emergency_braking()
+            # Fetch subscribed vehicle variables in a single batch
+            vehicles = traci.vehicle.getAllSubscriptionResults()
+
+            # Collect metrics (time series are sampled every metric_interval steps)
+            sim_time = self._begin_time + (step + 1) * self._dt
+            self.collect_step(step, sim_time, vehicles)
 
             step += 1
 
         traci.close()
         # Store total number of adaptations
         self.metrics["adaptation_frequency"] = self.adaptation_count
+        self.metrics["metric_interval"] = metric_interval
         return self.metrics
 
-    def analyze_results(self, all_metrics):
+    @staticmethod
+    def analyze_results(all_metrics):
         """Analyze and visualize the collected metrics"""
         import matplotlib.pyplot as plt
 
@@ -176,7 +231,8 @@ class MixedTrafficSimulation:
             plt.figure(figsize=(10, 6))
             for rate in sorted(all_metrics.keys()):
                 values = all_metrics[rate][metric]
-                plt.plot(values, label=f'AV Rate {int(rate*100)}%')
+                interval = all_metrics[rate]['metric_interval']
+                plt.plot(np.arange(len(values)) * interval, values, label=f'AV Rate {int(rate*100)}%')
 
             plt.xlabel('Simulation Step')
             plt.ylabel(ylabel)
@@ -187,7 +243,8 @@ class MixedTrafficSimulation:
             plt.savefig(os.path.join(output_dir, f"{metric}_{timestamp}.png"))
             plt.close()
 
-    def save_metrics_to_csv(self, all_metrics, output_dir="../results"):
+    @staticmethod
+    def save_metrics_to_csv(all_metrics, output_dir="../results"):
         """Save metrics in a structured format"""
         os.makedirs(output_dir, exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -216,12 +273,12 @@ class MixedTrafficSimulation:
                 writer.writerow(['AV Rate (%)', 'Average', 'Maximum', 'Minimum', 'Final Value'])
 
                 for rate in sorted(all_metrics.keys()):
-                    values = all_metrics[rate][metric]
+                    values = np.asarray(all_metrics[rate][metric], dtype=np.float32)
                     writer.writerow([
                         int(rate*100),
-                        f'{np.mean(values):.2f}',
-                        f'{np.max(values):.2f}',
-                        f'{np.min(values):.2f}',
+                        f'{values.mean():.2f}',
+                        f'{values.max():.2f}',
+                        f'{values.min():.2f}',
                         f'{values[-1]:.2f}'
                     ])
                 writer.writerow([])
@@ -246,23 +303,28 @@ class MixedTrafficSimulation:
                     all_metrics[rate]['emergency_braking_human']
                 ])
 
+def _run_one(rate):
+    """Run a single simulation in a worker process"""
+    print(f"Running simulation with AV penetration rate: {rate*100}%")
+    sim = MixedTrafficSimulation(
+        config_file="due.actuated.sumocfg",
+        av_penetration_rate=rate
+    )
+    metrics = sim.run()
+    print(f"Simulation completed for AV rate: {rate*100}%")
+    return rate, metrics
+
 def main():
     # av_rates = [0.0, 0.25, 0.5, 0.75, 1.0]  # Full range
     av_rates = [0.0, 0.5, 1.0]  # Reduced for faster execution
-    all_metrics = {}
-
-    for rate in av_rates:
-        print(f"Running simulation with AV penetration rate: {rate*100}%")
-        sim = MixedTrafficSimulation(
-            config_file="due.actuated.sumocfg",
-            av_penetration_rate=rate
-        )
-        metrics = sim.run()
-        all_metrics[rate] = metrics
-        print(f"Simulation completed for AV rate: {rate*100}%")
-
-    sim.save_metrics_to_csv(all_metrics)
-    sim.analyze_results(all_metrics)
+
+    # Simulations are independent, so run them in parallel; each worker
+    # starts its own SUMO instance (TraCI picks a free port per process)
+    with Pool(len(av_rates)) as pool:
+        all_metrics = dict(pool.map(_run_one, av_rates))
+
+    MixedTrafficSimulation.save_metrics_to_csv(all_metrics)
+    MixedTrafficSimulation.analyze_results(all_metrics)
 
 if __name__ == "__main__":
     main()